@@ -2,9 +2,13 @@
 # Copyright (c) 2018 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
 # Licensed under the Apache License, Version 2.0
 
+import os
+import yaml
 import pandas as pd
 import numpy as np
 
+from pythutils.mathutils import weighted_smooth
+
 def _list_to_coords(list):
 
     coords = [(int(i),int(j)) for i,j in list if i==i]
@@ -13,7 +17,9 @@ def _list_to_coords(list):
     return coords, loclist
 
 
-def create_emptydf(cols = ["x","y","fx","fy"], ids = [1], first = 1, last = None):
+def create_emptydf(cols = ["x","y","fx","fy"], ids = [1], first = 1, last = None,
+                   float32 = False, idtype = None, order = "frame",
+                   compact = False):
 
     """
     Creates an emtpy pandas dataframe, aimed to hold coordinate data
@@ -22,33 +28,129 @@ def create_emptydf(cols = ["x","y","fx","fy"], ids = [1], first = 1, last = None
     ids : a list of animal ids
     first : start frame
     last : last frame
+    float32 : bool, default = False
+        If the coordinate columns should be float32 instead of float64
+    idtype : str, default = None
+        Dtype for the id column, such as "category" or "int16". If None, it
+        is inferred from the ids.
+    order : str, default = "frame"
+        If rows should be ordered by "frame" and then id, or by "id" and then
+        frame
+    compact : bool, default = False
+        If the smallest safe dtypes should be used, see compact_df
     """
 
     try:
-        framerange = range(first, last + 1)
+        framerange = np.arange(first, last + 1)
     except TypeError:
         raise TypeError("No last value provided..")
+    if order not in ("frame", "id"):
+        raise ValueError("order should be 'frame' or 'id'..")
+
+    idcodes = np.arange(len(ids))
+    if order == "frame":
+        frames = np.repeat(framerange, len(ids))
+        idcodes = np.tile(idcodes, len(framerange))
+    else:
+        frames = np.tile(framerange, len(ids))
+        idcodes = np.repeat(idcodes, len(framerange))
+
+    if idtype == "category":
+        idcol = pd.Categorical.from_codes(idcodes, categories = ids)
+    else:
+        idcol = pd.Index(ids).take(idcodes).to_numpy()
+        if idtype is not None:
+            idcol = idcol.astype(idtype)
+
+    dtype = np.float32 if float32 else np.float64
+    data = {"frame": frames, "id": idcol}
+    for col in cols:
+        data[col] = np.full(len(frames), np.nan, dtype = dtype)
 
-    colnames = ["frame","id"] + cols
-    emptycols = list(np.repeat(np.nan, len(cols)))
+    data = pd.DataFrame(data, columns = ["frame","id"] + cols)
 
-    for i, id in enumerate(ids):
-        sub = pd.DataFrame([[frame, id] + emptycols for frame in framerange],
-              columns = colnames)
-        data = sub if i == 0 else pd.concat([data, sub])
+    return compact_df(data, columns = cols) if compact else data
 
-    data = data.sort_values(["frame"])
-    data.index = range(0, data.index.size, 1)
+
+def compact_df(data, float32 = True, columns = ["x","y","fx","fy"],
+               report = False):
+
+    """
+    Returns a copy of a dataframe with the smallest safe dtypes: an unsigned
+    integer frame column, the smallest integer or a categorical id column,
+    downcasted other integer columns and, if float32, float32 instead of
+    float64 coordinate columns
+
+    columns : list of str, default = ["x","y","fx","fy"]
+        The float columns that may be downcasted to float32. Other float
+        columns are only downcasted if no precision is lost
+    report : bool, default = False
+        If the memory saved should be printed
+    """
+
+    before = data.memory_usage(deep = report).sum()
+    data = data.copy()
+
+    for col in data.columns:
+        values = data[col]
+        if col == "frame" and pd.api.types.is_integer_dtype(values) and \
+           (len(values) == 0 or values.min() >= 0):
+            data[col] = pd.to_numeric(values, downcast = "unsigned")
+        elif pd.api.types.is_integer_dtype(values):
+            data[col] = pd.to_numeric(values, downcast = "integer")
+        elif pd.api.types.is_float_dtype(values):
+            if not float32:
+                continue
+            small = values.astype(np.float32)
+            if col in columns or np.array_equal(small.to_numpy(dtype = float),
+                                                values.to_numpy(dtype = float),
+                                                equal_nan = True):
+                data[col] = small
+        elif col == "id" and not isinstance(values.dtype, pd.CategoricalDtype):
+            data[col] = values.astype("category")
+
+    if report:
+        after = data.memory_usage(deep = True).sum()
+        print("Reduced memory from %.1f MB to %.1f MB (%.0f%% saved).." %
+              (before/1e6, after/1e6, 100*(1-after/max(before, 1))))
 
     return data
 
 
+def _pd_to_coordarray(pdat, columns = ["x","y"], multiplier = 1):
+
+    """
+    Returns an (N,1,2) int32 array of the valid coordinates and an array of
+    their frames, using column masks only
+    """
+
+    xy = pdat[columns].to_numpy(dtype = float)
+
+    return _to_coordarray(xy, pdat["frame"].to_numpy(), multiplier)
+
+
+def _to_coordarray(xy, frames, multiplier = 1):
+
+    mask = ~np.isnan(xy).any(axis = 1)
+    xy = np.trunc(xy[mask])
+    if multiplier != 1:
+        xy = np.trunc(xy * multiplier)
+    coords = xy.astype(np.int32).reshape((-1,1,2))
+
+    return coords, frames[mask]
+
+
 def pd_to_coords(pdat, loc = None, array = False, columns = ["x","y"],
-                 multiplier = 1):
+                 multiplier = 1, native = False):
 
     """
     Returns either a single coordinate of integers or a list or an array of
     arrays with coordinates with a list of frames
+
+    native : bool, default = False
+        If an (N,1,2) int32 array of coordinates, as used by opencv polylines
+        and draw_traj, and an array of frames should be returned directly from
+        the columns, without any per-row conversion
     """
 
     if loc != None:
@@ -59,14 +161,15 @@ def pd_to_coords(pdat, loc = None, array = False, columns = ["x","y"],
             c = coords[0]
             return (int(c[0]*multiplier),int(c[1]*multiplier))
 
+    elif native or array:
+        coords, frames = _pd_to_coordarray(pdat, columns, multiplier)
+        return (coords, frames) if native else (coords, frames.tolist())
+
     else:
         coords, loclist = _list_to_coords(list(zip(pdat[columns[0]],
                                                    pdat[columns[1]])))
         framelist = [pdat.loc[i,"frame"] for i in loclist]
         coords = [(int(c[0]*multiplier),int(c[1]*multiplier)) for c in coords]
-        if array:
-            coords = [[[i] for i in coords]]
-            coords = np.array(coords, np.int32).reshape((-1,1,2))
 
         return coords, framelist
 
@@ -81,6 +184,184 @@ def dfchange(df1, df2):
     return dfchanges, nchanges
 
 
+def _hashrows(df, cols, chunksize = None):
+
+    """Returns a uint64 hash per row of the given columns, computed in chunks"""
+
+    if len(cols) == 0:
+        return np.zeros(len(df), dtype = np.uint64)
+    chunksize = max(len(df), 1) if chunksize is None else chunksize
+    hashes = np.empty(len(df), dtype = np.uint64)
+    for i in range(0, len(df), chunksize):
+        chunk = df.iloc[i:i+chunksize][cols]
+        hashes[i:i+chunksize] = pd.util.hash_pandas_object(chunk, index = False)
+
+    return hashes
+
+
+def _lookup(sortedkeys, keys):
+
+    """Returns the positions of keys in sorted keys and if they were found"""
+
+    pos = np.searchsorted(sortedkeys, keys)
+    pos[pos == len(sortedkeys)] = 0
+    found = sortedkeys[pos] == keys if len(sortedkeys) else np.zeros(len(keys), bool)
+
+    return pos, found
+
+
+def dfdiff(df1, df2, keys = ["frame","id"], chunksize = None):
+
+    """
+    Determines the differences between two pandas dataframes by comparing rows
+    with the same keys, using row hashes. Keys should be unique and values
+    should have the same dtypes in both dataframes. Missing values compare
+    as equal.
+
+    Parameters
+    ----------
+    df1 : original pandas dataframe
+    df2 : new pandas dataframe
+    keys : list of columns that identify a row
+    chunksize : int, default = None
+        Number of rows to hash at once to limit memory use. If None, all rows
+        are hashed at once.
+
+    Returns
+    -------
+    added : rows of df2 with keys not in df1
+    removed : rows of df1 with keys not in df2
+    modified : rows of df2 with keys in df1 but with different values
+    """
+
+    cols = [col for col in df2.columns if col not in keys]
+    keys1 = _hashrows(df1, keys, chunksize)
+    keys2 = _hashrows(df2, keys, chunksize)
+    if len(np.unique(keys1)) < len(keys1) or len(np.unique(keys2)) < len(keys2):
+        raise ValueError("Keys are not unique..")
+
+    order = np.argsort(keys1)
+    pos, found = _lookup(keys1[order], keys2)
+    values1 = _hashrows(df1, cols, chunksize)[order]
+    values2 = _hashrows(df2, cols, chunksize)
+    changed = np.zeros(len(df2), bool)
+    changed[found] = values1[pos[found]] != values2[found]
+    _, kept = _lookup(np.sort(keys2), keys1)
+
+    added = df2[~found]
+    removed = df1[~kept]
+    modified = df2[changed]
+
+    return added, removed, modified
+
+
+class FrameIndex(object):
+
+    """
+    Index of a frame/id dataframe for fast lookups without query strings. The
+    frame and id columns and the value columns are sorted once by frame and
+    id, after which point lookups, frame ranges and id subsets use
+    searchsorted. Frame ranges return numpy views of the sorted columns.
+
+    Parameters
+    ----------
+    data : pandas dataframe with integer "frame" and "id" columns
+    columns : list of value columns to index, default = all other columns
+    """
+
+    def __init__(self, data, columns = None):
+
+        self.data = data
+        self.columns = [c for c in data.columns if c not in ("frame", "id")] \
+                       if columns is None else list(columns)
+
+        codes, self.ids = pd.factorize(data["id"])
+        frames = data["frame"].to_numpy()
+        self.order = np.lexsort((codes, frames))
+        identity = np.array_equal(self.order, np.arange(len(self.order)))
+        sort = (lambda x: x) if identity else (lambda x: x[self.order])
+
+        self.frames = sort(frames)
+        self.codes = sort(codes)
+        self.values = {col: sort(data[col].to_numpy()) for col in self.columns}
+
+        self._first = self.frames[0] if len(self.frames) else 0
+        self._keys = self._key(self.frames, self.codes)
+
+    def __len__(self):
+
+        return len(self.frames)
+
+    def _key(self, frames, codes):
+
+        return (np.asarray(frames, dtype = np.int64) - self._first) * \
+               len(self.ids) + codes
+
+    def locate(self, frames, ids):
+
+        """
+        Returns the positions in the sorted columns of one or more frame and
+        id combinations, with -1 for those that are not present
+        """
+
+        codes = self.ids.get_indexer(np.atleast_1d(ids))
+        keys = self._key(np.atleast_1d(frames), codes)
+        pos = np.searchsorted(self._keys, keys)
+        pos[pos == len(self._keys)] = 0
+        found = (codes >= 0) & (self._keys[pos] == keys) if len(self) else False
+        pos = np.where(found, pos, -1)
+
+        return pos[0] if np.ndim(frames) == 0 and np.ndim(ids) == 0 else pos
+
+    def get(self, col, frames, ids, default = np.nan):
+
+        """
+        Returns the value(s) of a column for one or more frame and id
+        combinations, with default for those that are not present
+        """
+
+        pos = self.locate(frames, ids)
+        if len(self) == 0:
+            return np.full(np.shape(pos), default)
+        values = self.values[col][pos]
+
+        return np.where(pos >= 0, values, default)
+
+    def select(self, first, last = None, ids = None):
+
+        """
+        Returns a slice of the sorted columns for the frames from first to
+        last (inclusive), or an array of positions if ids are provided
+        """
+
+        last = first if last is None else last
+        start = np.searchsorted(self.frames, first, "left")
+        stop = np.searchsorted(self.frames, last, "right")
+        if ids is None:
+            return slice(start, stop)
+
+        codes = self.ids.get_indexer(np.atleast_1d(ids))
+        mask = np.isin(self.codes[start:stop], codes[codes >= 0])
+
+        return start + np.flatnonzero(mask)
+
+    def frame(self, col, first, last = None, ids = None):
+
+        """
+        Returns the values of a column for the frames from first to last
+        (inclusive), optionally for a subset of ids. Without ids a view of
+        the sorted column is returned.
+        """
+
+        return self.values[col][self.select(first, last, ids)]
+
+    def rows(self, first, last = None, ids = None):
+
+        """Returns the rows of the original dataframe for the selection"""
+
+        return self.data.iloc[self.order[self.select(first, last, ids)]]
+
+
 def to_query(cols, vals):
 
     """Returns a query from a list of columns and values"""
@@ -99,3 +380,385 @@ def contour_to_tuple(contour):
     conttuple = [(row[0][0], row[0][1]) for row_idx, row in enumerate(contour)]
 
     return conttuple
+
+
+def contours_to_array(contours):
+
+    """
+    Converts a list of contours, such as from cv2.findContours, to a single
+    (P,2) int32 array of all points and an array of K+1 offsets, such that the
+    points of contour k are points[offsets[k]:offsets[k+1]]
+    """
+
+    lengths = [len(c) for c in contours]
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
+    if len(contours) == 0:
+        return np.empty((0, 2), dtype = np.int32), offsets
+
+    points = np.concatenate([np.reshape(c, (-1, 2)) for c in contours])
+
+    return points.astype(np.int32, copy = False), offsets
+
+
+def array_to_contours(points, offsets):
+
+    """
+    Returns a list of (N,1,2) views of the individual contours from the
+    points and offsets of contours_to_array
+    """
+
+    return [points[offsets[k]:offsets[k+1]].reshape(-1, 1, 2)
+            for k in range(len(offsets) - 1)]
+
+
+def _id_order(data):
+
+    """
+    Returns the order that sorts a dataframe by id and frame, and a mask of
+    the sorted rows that start a new id
+    """
+
+    codes, _ = pd.factorize(data["id"])
+    order = np.lexsort((data["frame"].to_numpy(), codes))
+    newgroup = np.ones(len(order), bool)
+    newgroup[1:] = codes[order][1:] != codes[order][:-1]
+
+    return order, newgroup
+
+
+def _groupdiff(values, newgroup):
+
+    """Backward difference of a sorted array, NaN at the start of each group"""
+
+    diff = np.empty_like(values)
+    if len(values) == 0:
+        return diff
+    diff[0] = np.nan
+    np.subtract(values[1:], values[:-1], out = diff[1:])
+    diff[newgroup] = np.nan
+
+    return diff
+
+
+def kinematics(data, columns = ["x","y"], fps = None, flip = False,
+               float32 = False):
+
+    """
+    Computes movement statistics for all ids of a frame/id coordinate dataframe
+    in one grouped pass. Returns a copy of the dataframe with added columns:
+
+    dist : distance moved since the previous frame of the same id
+    speed : distance moved per frame, or per second if fps is provided
+    accel : change in speed per frame, or per second if fps is provided
+    heading : direction of movement in degrees, using the same north-pointing
+        -180 to 180 degrees coordinate system as mathutils.points_to_angle
+    turn : change in heading since the previous frame, from -180 to 180
+
+    Values that cannot be computed, such as for the first frame of each id,
+    are NaN. Gaps in the frame numbers are taken into account.
+
+    Parameters
+    ----------
+    data : pandas dataframe with "frame" and "id" columns
+    columns : list of the x and y column names
+    fps : float, default = None
+        Frame rate to express speed and acceleration per second
+    flip : bool, default = False
+        If the coordinate system should be flipped such that higher y-coords
+        are lower (e.g. needed when working with images in opencv).
+    float32 : bool, default = False
+        If the computations and output should use float32 to save memory
+    """
+
+    dtype = np.float32 if float32 else np.float64
+    frames = data["frame"].to_numpy(dtype = np.float64)
+    order, newgroup = _id_order(data)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        dt = _groupdiff(frames[order], newgroup).astype(dtype)
+        if fps is not None:
+            dt /= dtype(fps)
+        dx = _groupdiff(data[columns[0]].to_numpy(dtype = dtype)[order], newgroup)
+        dy = _groupdiff(data[columns[1]].to_numpy(dtype = dtype)[order], newgroup)
+        dy = -dy if flip else dy
+        dist = np.hypot(dx, dy)
+        speed = dist / dt
+        accel = _groupdiff(speed, newgroup) / dt
+        heading = np.degrees(np.arctan2(dx, dy))
+        turn = (_groupdiff(heading, newgroup) + 180) % 360 - 180
+
+    data = data.copy()
+    for col, values in (("dist", dist), ("speed", speed), ("accel", accel),
+                        ("heading", heading), ("turn", turn)):
+        out = np.empty_like(values)
+        out[order] = values
+        data[col] = out
+
+    return data
+
+
+def kinematics_chunks(chunks, columns = ["x","y"], **kwargs):
+
+    """
+    Streaming version of kinematics that takes an iterable of dataframe chunks,
+    such as from pd.read_csv(chunksize = ...), and yields each chunk with the
+    movement statistics added. Chunks should be in frame order. The last two
+    rows of each id are carried over such that the results are identical to
+    running kinematics on the full data.
+    """
+
+    tail = None
+    for chunk in chunks:
+        ntail = 0 if tail is None else len(tail)
+        if tail is not None:
+            chunk = pd.concat([tail, chunk])
+        result = kinematics(chunk, columns = columns, **kwargs)
+        tail = chunk.sort_values("frame", kind = "stable")
+        tail = tail.groupby("id", sort = False, observed = True).tail(2)
+        yield result.iloc[ntail:]
+
+
+def smooth_traj(data, columns = ["x","y"], w = 1.7, length = 20,
+                causal = False):
+
+    """
+    Returns a copy of a frame/id coordinate dataframe with the coordinate
+    columns smoothed per id with mathutils.weighted_smooth. Missing
+    coordinates remain NaN. Smoothing is based on consecutive rows of each id
+    ordered by frame. For smoothing live data, see mathutils.WeightedSmoother.
+    """
+
+    order, newgroup = _id_order(data)
+    values = data[columns].to_numpy(dtype = float)[order]
+    bounds = np.append(np.flatnonzero(newgroup), len(order))
+
+    smoothed = np.empty_like(values)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        smoothed[order[start:stop]] = weighted_smooth(values[start:stop], w,
+                                                      length, causal)
+
+    data = data.copy()
+    data[columns] = smoothed
+
+    return data
+
+
+def _appendfile(filename, values, nrows):
+
+    """
+    Writes values to a binary file after the first nrows values, discarding
+    anything written beyond them
+    """
+
+    mode = "r+b" if os.path.exists(filename) else "wb"
+    with open(filename, mode) as f:
+        f.seek(nrows * values.dtype.itemsize)
+        f.write(values.tobytes())
+        f.truncate()
+
+
+class TrajStore(object):
+
+    """
+    On-disk columnar store of frame/id coordinate data backed by np.memmap.
+    Data can be appended in chunks while tracking, in increasing frame order,
+    and read back by frame range or id without loading the full data.
+
+    Each column is stored as a raw binary file in the store directory, next
+    to a meta.yml file with the columns, dtypes, ids and number of rows. Ids
+    are stored as integer codes. Frame offsets and per-id row positions are
+    kept such that locating a frame range or an id is O(1).
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store, which is created if it does not exist
+    cols : list of value columns, default = ["x","y"]
+        Only used when creating a new store
+    dtype : str, default = "float32"
+        Dtype of the value columns, only used when creating a new store
+    """
+
+    def __init__(self, path, cols = ["x","y"], dtype = "float32"):
+
+        self.path = path
+        self._metafile = os.path.join(path, "meta.yml")
+        if os.path.exists(self._metafile):
+            with open(self._metafile) as f:
+                self.meta = yaml.safe_load(f)
+        else:
+            if "frame" in cols or "id" in cols:
+                raise ValueError("frame and id are reserved column names..")
+            os.makedirs(os.path.join(path, "ids"), exist_ok = True)
+            self.meta = {"cols": list(cols), "dtype": str(np.dtype(dtype)),
+                         "ids": [], "nrows": 0, "firstframe": None,
+                         "nframes": 0}
+            self._savemeta()
+
+        self.cols = self.meta["cols"]
+        self.ids = pd.Index(self.meta["ids"])
+        self._dtypes = {"frame": np.dtype(np.int64), "id": np.dtype(np.int32),
+                        "offsets": np.dtype(np.int64)}
+        self._dtypes.update({c: np.dtype(self.meta["dtype"]) for c in self.cols})
+
+    def __len__(self):
+
+        return self.meta["nrows"]
+
+    def _savemeta(self):
+
+        with open(self._metafile, "w") as f:
+            yaml.safe_dump(self.meta, f)
+
+    def _file(self, col):
+
+        return os.path.join(self.path, col + ".dat")
+
+    def _idfile(self, code):
+
+        return os.path.join(self.path, "ids", str(code) + ".dat")
+
+    def _memmap(self, filename, dtype, n):
+
+        if n == 0:
+            return np.empty(0, dtype = dtype)
+
+        return np.memmap(filename, dtype = dtype, mode = "r", shape = (n,))
+
+    def _idpositions(self, code):
+
+        """
+        Returns the committed row positions of an id code, ignoring positions
+        left behind by an append that was interrupted before saving the meta
+        """
+
+        idfile = self._idfile(code)
+        if not os.path.exists(idfile):
+            return np.empty(0, dtype = np.int64)
+        pos = self._memmap(idfile, np.int64, os.path.getsize(idfile) // 8)
+
+        return pos[:np.searchsorted(pos, len(self))]
+
+    def column(self, col):
+
+        """Returns a read-only memmap of a column ("frame", "id" or value)"""
+
+        return self._memmap(self._file(col), self._dtypes[col], len(self))
+
+    def append(self, data):
+
+        """
+        Appends a chunk of rows, given as a dataframe or dict of arrays with
+        "frame", "id" and the value columns. Frames should be sorted and not
+        lower than the last frame in the store.
+        """
+
+        frames = np.asarray(data["frame"], dtype = np.int64)
+        if len(frames) == 0:
+            return
+        nrows, nframes = self.meta["nrows"], self.meta["nframes"]
+        first = frames[0] if self.meta["firstframe"] is None \
+                else self.meta["firstframe"]
+        if np.any(np.diff(frames) < 0) or frames[0] < first + nframes - 1:
+            raise ValueError("Frames should be appended in increasing order..")
+
+        ids = np.asarray(data["id"])
+        newids = [i for i in pd.unique(ids) if i not in self.ids]
+        if len(newids) > 0:
+            self.ids = self.ids.append(pd.Index(newids))
+            self.meta["ids"] = [i.item() if hasattr(i, "item") else i
+                                for i in self.ids]
+        codes = self.ids.get_indexer(ids).astype(np.int32)
+
+        for col in self.cols:
+            values = np.asarray(data[col], dtype = self._dtypes[col])
+            _appendfile(self._file(col), values, nrows)
+        _appendfile(self._file("frame"), frames, nrows)
+        _appendfile(self._file("id"), codes, nrows)
+
+        # start rows of all new frame numbers, including gaps
+        newframes = np.arange(first + nframes, frames[-1] + 1)
+        offsets = nrows + np.searchsorted(frames, newframes, "left")
+        _appendfile(self._file("offsets"), offsets, nframes)
+
+        # row positions per id
+        order = np.argsort(codes, kind = "stable")
+        uniq, starts = np.unique(codes[order], return_index = True)
+        for code, pos in zip(uniq, np.split(order + nrows, starts[1:])):
+            n = len(self._idpositions(code))
+            _appendfile(self._idfile(code), pos.astype(np.int64), n)
+
+        self.meta.update({"nrows": nrows + len(frames), "firstframe": int(first),
+                          "nframes": nframes + len(newframes)})
+        self._savemeta()
+
+    def select(self, first = None, last = None):
+
+        """Returns the slice of rows of the frames from first to last"""
+
+        nframes = self.meta["nframes"]
+        if nframes == 0:
+            return slice(0, 0)
+        offsets = self._memmap(self._file("offsets"), np.int64, nframes)
+        firstframe = self.meta["firstframe"]
+        last = first if last is None and first is not None else last
+        k1 = 0 if first is None else min(max(first - firstframe, 0), nframes)
+        k2 = nframes if last is None else min(max(last - firstframe + 1, 0), nframes)
+        start = int(offsets[k1]) if k1 < nframes else len(self)
+        stop = int(offsets[k2]) if k2 < nframes else len(self)
+
+        return slice(start, max(start, stop))
+
+    def positions(self, id, first = None, last = None):
+
+        """Returns the row positions of an id, optionally for a frame range"""
+
+        code = self.ids.get_indexer([id])[0]
+        if code < 0:
+            return np.empty(0, dtype = np.int64)
+        pos = self._idpositions(code)
+        if first is not None or last is not None:
+            rows = self.select(first, last)
+            pos = pos[np.searchsorted(pos, rows.start):
+                      np.searchsorted(pos, rows.stop)]
+
+        return pos
+
+    def read(self, first = None, last = None, id = None, cols = None):
+
+        """
+        Returns a dict of column arrays for a frame range and/or an id. Frame
+        ranges are memmap views, id selections are copies.
+        """
+
+        cols = ["frame", "id"] + self.cols if cols is None else cols
+        rows = self.select(first, last) if id is None \
+               else self.positions(id, first, last)
+
+        return {col: self.column(col)[rows] for col in cols}
+
+    def to_df(self, first = None, last = None, id = None):
+
+        """
+        Returns the data as a dataframe in the layout of create_emptydf, with
+        a categorical id column, without copying the columns where possible
+        """
+
+        data = self.read(first, last, id)
+        data["id"] = pd.Categorical.from_codes(data["id"], categories = self.ids)
+
+        return pd.DataFrame(data, copy = False)
+
+    def to_coords(self, id, first = None, last = None, columns = ["x","y"],
+                  multiplier = 1):
+
+        """
+        Returns an (N,1,2) int32 array of the valid coordinates of an id and an
+        array of their frames, as pd_to_coords with native=True
+        """
+
+        data = self.read(first, last, id, cols = ["frame"] + list(columns))
+        xy = np.column_stack([data[columns[0]], data[columns[1]]])
+
+        return _to_coordarray(xy.astype(float), data["frame"], multiplier)
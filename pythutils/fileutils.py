@@ -3,12 +3,73 @@
 # Licensed under the Apache License, Version 2.0
 
 import os
+import re
+import sys
 import ast
+import copy
+import errno
+import hashlib
+import shutil
+import time
+import contextlib
 import yaml
+import struct
+import select
+import functools
+import threading
+
+def _movefile(file, newfile):
+
+    """
+    Moves a file, copying it and removing the original if it is moved to
+    another device. Returns the number of bytes copied.
+    """
+
+    try:
+        os.rename(file, newfile)
+        return 0
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    size = os.path.getsize(file)
+    tmpfile = newfile + ".part"
+    try:
+        shutil.copy2(file, tmpfile)
+        with open(tmpfile, "rb+") as f:
+            os.fsync(f.fileno())
+        if os.path.getsize(tmpfile) != size:
+            raise OSError("Copy of "+file+" is incomplete..")
+    except OSError:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.replace(tmpfile, newfile)
+    _fsyncdir(os.path.dirname(newfile))
+    os.remove(file)
+
+    return size
+
+
+def _fsyncdir(dir):
+
+    """Flushes a directory entry to disk, where the platform supports it"""
+
+    try:
+        fd = os.open(dir or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 
 def move(file, newdir):
 
-    """Moves a file to new location"""
+    """Moves a file to new location, also across devices"""
 
     if not os.path.isfile(file):
         raise OSError("Provided file does not exist..")
@@ -17,15 +78,159 @@ def move(file, newdir):
         raise OSError("Provided newdir is no directory..")
 
     path, filename = os.path.split(file)
-    print(path, filename)
     if path == "":
         path = os.getcwd()
-    os.rename(path+"/"+filename, newdir+"/"+filename)
+    _movefile(path+"/"+filename, newdir+"/"+filename)
 
 
-import os
+def movefiles(files, newdir, workers = 4, verbose = True):
+
+    """
+    Moves a list of files to a new directory. Files are renamed when on the
+    same device, otherwise they are copied in parallel, checked for size,
+    flushed to disk and then removed. Files that would overwrite an existing
+    file in newdir, or that share their name with another file in the list,
+    are not moved and reported as failed.
+
+    Parameters
+    ----------
+    files : list of file paths
+    newdir : str
+        Directory to move the files to
+    workers : int, default = 4
+        Number of threads to copy files across devices
+    verbose : bool, default = True
+        If a summary with the throughput should be printed
+
+    Returns
+    -------
+    summary : dict with the moved and failed files, the number of bytes
+        copied, the time taken in seconds and the throughput in MB/s
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not os.path.isdir(newdir):
+        raise OSError("Provided newdir is no directory..")
+
+    names = [os.path.basename(file) for file in files]
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+
+    def _move(args):
+        file, name = args
+        newfile = os.path.join(newdir, name)
+        try:
+            if counts[name] > 1:
+                raise FileExistsError(errno.EEXIST, "Multiple files named "+
+                                      name+" in batch..", newfile)
+            if os.path.lexists(newfile):
+                raise FileExistsError(errno.EEXIST, "File exists in newdir..",
+                                      newfile)
+            return newfile, _movefile(file, newfile), None
+        except OSError as error:
+            return file, 0, error
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = max(workers, 1)) as pool:
+        results = list(pool.map(_move, zip(files, names)))
+    seconds = time.time() - start
+
+    nbytes = sum(size for _, size, _ in results)
+    summary = {"moved": [f for f, _, error in results if error is None],
+               "failed": [(f, error) for f, _, error in results if error],
+               "bytes": nbytes, "seconds": seconds,
+               "throughput": nbytes / 1e6 / seconds if seconds > 0 else 0}
+
+    if verbose:
+        from pythutils.sysutils import lineprint
+        lineprint("Moved %d files (%d failed), copied %.1f MB at %.1f MB/s.." %
+                  (len(summary["moved"]), len(summary["failed"]), nbytes / 1e6,
+                   summary["throughput"]))
+
+    return summary
+
+
+def _exttuple(type):
+
+    """Returns a tuple of lower-case file extensions"""
+
+    if isinstance(type, str):
+        type = (type,) if type else ()
+
+    return tuple(ext.lower() for ext in type)
+
+
+def _scandir(dir, exts, skiperrors=False):
 
-def listfiles(dir=".", type="", keepdir=False, keepext=True, nested=False):
+    """
+    Returns the matching file entries and subdirectories of a directory.
+    Symbolic links to directories are not followed. If skiperrors, an
+    unreadable directory is skipped as with os.walk.
+    """
+
+    files, subdirs = [], []
+    try:
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not entry.name.startswith('.') and entry.is_file() and \
+                     (not exts or entry.name.lower().endswith(exts)):
+                    files.append(entry)
+    except OSError:
+        if not skiperrors:
+            raise
+
+    return files, subdirs
+
+
+def iterfiles(dir=".", type="", nested=False, workers=1):
+    """
+    Lazily yields the files in a directory as os.DirEntry objects, which
+    provide the name, path and a cached stat() with size and mtime. Order is
+    not sorted.
+
+    Parameters
+    ----------
+    dir : str
+        Directory that should be checked.
+    type : str or tuple of str
+        File extension(s) to match (case-insensitive).
+    nested : bool
+        If True, looks recursively in subfolders.
+    workers : int
+        Number of threads to scan subfolders in parallel when nested.
+    """
+
+    exts = _exttuple(type)
+
+    if not nested or workers <= 1:
+        dirs = [dir]
+        while dirs:
+            files, subdirs = _scandir(dirs.pop(), exts, nested)
+            for entry in files:
+                yield entry
+            if nested:
+                dirs.extend(reversed(subdirs))
+        return
+
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scandir, dir, exts, True)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(pool.submit(_scandir, d, exts, True)
+                               for d in subdirs)
+                for entry in files:
+                    yield entry
+
+
+def listfiles(dir=".", type="", keepdir=False, keepext=True, nested=False,
+              workers=1):
     """
     Returns a list of (nested) files or directories.
 
@@ -41,28 +246,12 @@ def listfiles(dir=".", type="", keepdir=False, keepext=True, nested=False):
         If False, strips file extensions from results.
     nested : bool
         If True, looks recursively in subfolders.
+    workers : int
+        Number of threads to scan subfolders in parallel when nested.
     """
 
-    if isinstance(type, str):
-        type = (type,) if type else ()
-
-    outlist = []
-
-    if nested:
-        for root, dirs, files in os.walk(dir):
-            for file in files:
-                if not file.startswith('.') and file.lower().endswith(tuple(ext.lower() for ext in type)):
-                    filepath = os.path.join(root, file) if keepdir else file
-                    outlist.append(filepath)
-    else:
-        entries = os.listdir(dir)
-        files = [f for f in entries if os.path.isfile(os.path.join(dir, f))]
-        for f in files:
-            if not f.startswith('.') and (not type or f.lower().endswith(tuple(ext.lower() for ext in type))):
-                filepath = os.path.join(dir, f) if keepdir else f
-                outlist.append(filepath)
-
-    outlist = sorted(outlist)
+    outlist = sorted(e.path if keepdir else e.name
+                     for e in iterfiles(dir, type, nested, workers))
 
     if not keepext:
         outlist = [os.path.splitext(file)[0] for file in outlist]
@@ -71,11 +260,351 @@ def listfiles(dir=".", type="", keepdir=False, keepext=True, nested=False):
 
 
 
+def _inotify():
+
+    """Returns the C library if it supports inotify, otherwise None"""
+
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+class FileWatcher(object):
+
+    """
+    Watches a directory for new files and hands them off once they are fully
+    written. On Linux it uses inotify, where files are ready as soon as they
+    are closed after writing or moved into the directory. Elsewhere, or if
+    inotify is unavailable, the directory is only rescanned when its mtime
+    changes. Files for which no close event is seen, such as files that
+    were present at the start, are ready once their size and mtime have been
+    stable for settle seconds.
+
+    Parameters
+    ----------
+    dir : str
+        Directory to watch
+    type : str or tuple of str, default = ".h264"
+        File extension(s) to watch (case-insensitive)
+    settle : float, default = 2
+        Seconds the size of a file should be stable to be considered written
+    interval : float, default = 1
+        Seconds between checks when polling
+    existing : bool, default = True
+        If files already in the directory should also be handed off
+    inotify : bool, default = True
+        If inotify should be used when available
+    """
+
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_Q_OVERFLOW = 0x00004000
+
+    def __init__(self, dir, type=".h264", settle=2, interval=1, existing=True,
+                 inotify=True):
+
+        if not os.path.isdir(dir):
+            raise OSError("Provided dir is no directory..")
+        self.dir = dir
+        self.exts = _exttuple(type)
+        self.settle = settle
+        self.interval = interval
+        self.stopped = False
+
+        self._seen = set()
+        self._done = set()
+        self._pending = {}
+        self._ready = []
+        self._dirmtime = None
+
+        self._fd = None
+        libc = _inotify() if inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            mask = self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(dir), mask) >= 0:
+                self._fd = fd
+            elif fd >= 0:
+                os.close(fd)
+
+        self._scan(pending=existing)
+
+    def __iter__(self):
+
+        try:
+            while not self.stopped:
+                for file in self.poll():
+                    yield file
+        finally:
+            self.close()
+
+    def _match(self, name):
+
+        return not name.startswith('.') and \
+               (not self.exts or name.lower().endswith(self.exts))
+
+    def _scan(self, pending=True):
+
+        """
+        Adds unseen files in the directory as pending files, or as done files
+        if not pending
+        """
+
+        self._dirmtime = os.stat(self.dir).st_mtime_ns
+        for entry in iterfiles(self.dir, self.exts):
+            if entry.name not in self._seen:
+                self._seen.add(entry.name)
+                if pending:
+                    self._pending[entry.path] = (None, None, time.time())
+                else:
+                    self._done.add(entry.name)
+
+    def _readevents(self):
+
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = struct.unpack_from("iIII", buf, offset)
+            name = os.fsdecode(buf[offset+16:offset+16+length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & self._IN_Q_OVERFLOW:
+                self._scan()
+                # close events of created files may have been dropped as well
+                for name in self._seen - self._done:
+                    path = os.path.join(self.dir, name)
+                    self._pending.setdefault(path, (None, None, time.time()))
+            elif not self._match(name):
+                continue
+            elif mask & (self._IN_CLOSE_WRITE | self._IN_MOVED_TO):
+                path = os.path.join(self.dir, name)
+                self._pending.pop(path, None)
+                self._seen.add(name)
+                if name not in self._done:
+                    self._done.add(name)
+                    self._ready.append(path)
+            elif mask & self._IN_CREATE:
+                self._seen.add(name)
+
+    def _checkpending(self):
+
+        """Moves pending files whose size and mtime are stable to ready"""
+
+        now = time.time()
+        for path, (size, mtime, since) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                del self._pending[path]
+                if os.path.basename(path) not in self._done:
+                    self._done.add(os.path.basename(path))
+                    self._ready.append(path)
+
+    def poll(self, timeout=None):
+
+        """
+        Waits up to timeout seconds (default is interval) for file events and
+        returns the list of files that have become ready
+        """
+
+        timeout = self.interval if timeout is None else timeout
+        if self._fd is not None:
+            if self._pending:
+                timeout = min(timeout, self.interval)
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if ready:
+                self._readevents()
+        else:
+            time.sleep(timeout)
+            stat = os.stat(self.dir)
+            # also rescan shortly after a change, as mtimes can be coarse
+            if stat.st_mtime_ns != self._dirmtime or \
+               time.time() - stat.st_mtime < 2:
+                self._scan()
+
+        self._checkpending()
+        ready, self._ready = self._ready, []
+
+        return ready
+
+    def stop(self):
+
+        """Stops iterating after the current poll, also from other threads"""
+
+        self.stopped = True
+
+    def close(self):
+
+        """Closes the inotify handle"""
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FileJournal(object):
+
+    """
+    Append-only journal of processed files, such that a restarted process
+    can skip files that were already processed. Paths are stored as
+    absolute paths, one per line.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            # the last line is incomplete if writing was interrupted
+            with open(filename, "rb+") as f:
+                f.truncate(f.read().rfind(b"\n") + 1)
+            with open(filename) as f:
+                self.done.update(line for line in f.read().split("\n") if line)
+
+    def __contains__(self, file):
+
+        return os.path.abspath(file) in self.done
+
+    def __len__(self):
+
+        return len(self.done)
+
+    def add(self, file):
+
+        """Adds a file to the journal and flushes it to disk"""
+
+        file = os.path.abspath(file)
+        with self._lock:
+            with open(self.filename, "a") as f:
+                f.write(file + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.add(file)
+
+
+def _runfile(function, file, functionparams = ("file"), retries = 0,
+             retrydelay = 1):
+
+    """Runs a function on a file, retrying it if it raises an exception"""
+
+    for attempt in range(retries + 1):
+        try:
+            if "file" == functionparams:
+                return function(file)
+            elif "file" in functionparams:
+                return function(file, *functionparams[1:])
+            else:
+                return function(*functionparams)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(retrydelay)
+
+
+def process_files(files, function, functionparams = ("file"), workers = 1,
+                  processes = False, queuesize = None, retries = 0,
+                  retrydelay = 1, journal = None):
+
+    """
+    Runs a function on each file of an iterable, such as a FileWatcher, in
+    a pool of workers
+
+    Parameters
+    ===========
+    files : iterable of file paths
+    function :
+        function to use with the files
+    functionparams :
+        parameters for the function to use
+    workers : int, default = 1
+        Number of workers. With 1 the files are processed serially.
+    processes : bool, default = False
+        If a process pool should be used instead of a thread pool, in which
+        case the function should be picklable
+    queuesize : int, default = None
+        Maximum number of files queued or in progress, default is 2 x workers
+    retries : int, default = 0
+        Number of times to retry a file if the function raises an exception
+    retrydelay : float, default = 1
+        Seconds to wait before retrying a file
+    journal : str or FileJournal, default = None
+        Journal of completed files, which are skipped
+
+    Returns
+    -------
+    failed : list of files for which the function failed
+    """
+
+    from pythutils.sysutils import lineprint
+
+    if isinstance(journal, str):
+        journal = FileJournal(journal)
+    failed = []
+
+    def _finished(file, error = None):
+        if error is None:
+            if journal is not None:
+                journal.add(file)
+        else:
+            failed.append(file)
+            lineprint("Processing "+file+" failed: "+repr(error))
+
+    todo = (f for f in files if journal is None or f not in journal)
+
+    if workers <= 1:
+        for file in todo:
+            try:
+                _runfile(function, file, functionparams, retries, retrydelay)
+            except Exception as error:
+                _finished(file, error)
+            else:
+                _finished(file)
+        return failed
+
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    slots = threading.BoundedSemaphore(queuesize or 2 * workers)
+
+    def _done(file, future):
+        slots.release()
+        _finished(file, future.exception())
+
+    with Executor(max_workers = workers) as pool:
+        for file in todo:
+            slots.acquire()
+            future = pool.submit(_runfile, function, file, functionparams,
+                                 retries, retrydelay)
+            future.add_done_callback(functools.partial(_done, file))
+
+    return failed
+
+
 def filechecker(indir = "", outdir = "", move = True, type=".h264",
-                sleeptime = 2, function = None, functionparams = ("file")):
+                sleeptime = 2, function = None, functionparams = ("file"),
+                workers = 1, processes = False, retries = 0, journal = None):
 
         """
-        Repeatedly checks a directory for (new) files
+        Watches a directory for new files and runs a function on each new file
+        once it is fully written, until enter is pressed
 
         Parameters
         ===========
@@ -83,26 +612,33 @@ def filechecker(indir = "", outdir = "", move = True, type=".h264",
             Directory with original files to monitor
         outdir : str, default = ""
             Directory with new files to monitor
+        move : bool, default = True
+            If False, files that already exist in outdir are skipped
         type : str, default = ".h264"
             The type of file to monitor
         sleeptime : int, default = 2
-            Time in seconds between subsequent checks of file folder
+            Seconds a file's size should be stable to be considered written,
+            and time between checks when inotify is not available
         function :
-            function to use with the files to check
+            function to use with the files to check, which is given the full
+            path of the file
         functionparams :
             parameters for the function to use
+        workers : int, default = 1
+            Number of workers to process files in parallel
+        processes : bool, default = False
+            If a process pool should be used instead of a thread pool
+        retries : int, default = 0
+            Number of times to retry a file if the function fails
+        journal : str, default = None
+            File to keep a journal of processed files, which are skipped
+            when filechecker is restarted
         """
 
-        global interrupted
-        interrupted = False
-        def keythread():
-            global interrupted
-            input()
-            interrupted = True
-        Thread(target=keythread).start()
+        from pythutils.sysutils import lineprint
 
         if function is None:
-            raise Inputerror("No function is provided")
+            raise ValueError("No function is provided")
         indir = os.getcwd() if indir == "" else indir
         if not os.path.exists(indir):
             raise OSError("in-directory does not exist..")
@@ -110,27 +646,24 @@ def filechecker(indir = "", outdir = "", move = True, type=".h264",
         if not os.path.exists(outdir):
             raise OSError("out-directory does not exist..")
 
-        rootdir = os.getcwd()
-        os.chdir(indir)
-
-        while not interrupted:
-            files = listfiles(indir, type, keepdir = False)
-            if not move:
-                old = listfiles(indir, type, keepext = False)
-                new = listfiles(outdir, type, keepext = False)
-                files = [files[i] for i,file in enumerate(old) if file not in new]
-            for file in files:
-                if "file" == functionparams:
-                    function(file)
-                elif "file" in functionparams:
-                    function(file, *functionparams[1:])
-                else:
-                    function(*functionparams)
+        watcher = FileWatcher(indir, type, settle = sleeptime,
+                              interval = sleeptime)
+        def keythread():
+            input()
+            watcher.stop()
+        threading.Thread(target=keythread, daemon=True).start()
+
+        def _unprocessed(file):
+            base = os.path.splitext(os.path.basename(file))[0]
+            return not any(os.path.exists(os.path.join(outdir, base + ext))
+                           for ext in watcher.exts)
 
-            lineprint("No files found, rechecking in "+str(sleeptime)+"s..")
-            time.sleep(sleeptime)
+        lineprint("Watching "+indir+" for new files..")
+        files = watcher if move else filter(_unprocessed, watcher)
+        process_files(files, function, functionparams, workers = workers,
+                      processes = processes, retries = retries,
+                      journal = journal)
 
-        os.chdir(rootdir)
         lineprint("Filechecking stopped..")
 
 
@@ -139,8 +672,12 @@ def commonpref(pathlist = None, remove = False):
     """Given a list of paths, returns the longest common leading component"""
 
     if pathlist is None: return ""
+    if not isinstance(pathlist, list):
+        pathlist = list(pathlist)
+    if len(pathlist) == 0: return [] if remove else ""
     s1 = min(pathlist)
     s2 = max(pathlist)
+    commcomp = s1
     for i, c in enumerate(s1):
         if c != s2[i]:
             commcomp = s1[:i]
@@ -148,13 +685,229 @@ def commonpref(pathlist = None, remove = False):
 
     if remove:
         for each in range(len(pathlist)):
-            pathlist[each] = pathlist[each].split(commcomp, 1)[-1]
+            pathlist[each] = pathlist[each][len(commcomp):]
         return pathlist
 
     else:
         return commcomp
 
 
+def commonpath(paths):
+
+    """
+    Returns the longest common leading path of an iterable of paths, such as
+    a generator, in one pass. Unlike commonpref, paths are compared by their
+    components, such that "/data/vid1" and "/data/vid2" give "/data". Paths
+    are normalized first, as with os.path.commonpath.
+    """
+
+    prefix = None
+    for path in paths:
+        path = os.path.normpath(path)
+        if prefix is None:
+            parts = path.split(os.sep)
+            prefix = path
+            continue
+        if path == prefix or path.startswith(prefix + os.sep):
+            continue
+        other = path.split(os.sep)
+        n = 0
+        for a, b in zip(parts, other):
+            if a != b:
+                break
+            n += 1
+        del parts[n:]
+        prefix = os.sep.join(parts)
+        if parts == [""]:
+            prefix = os.sep
+
+    return "" if prefix is None else prefix
+
+
+def relpaths(paths, base = None):
+
+    """
+    Lazily yields the paths relative to a base path. If base is None, the
+    common path of all paths is used, for which the paths are first read.
+    """
+
+    if base is None:
+        paths = list(paths)
+        base = commonpath(paths)
+    start = base if base == "" or base.endswith(os.sep) else base + os.sep
+
+    for path in paths:
+        if path.startswith(start):
+            yield path[len(start):]
+        elif path == base:
+            yield "."
+        else:
+            yield os.path.relpath(path, base)
+
+
+def fingerprint(file, full = False, blocksize = 1 << 20, nblocks = 8):
+
+    """
+    Returns a content hash of a file. By default only nblocks evenly spaced
+    blocks and the file size are hashed, which is fast for large media files.
+    If full, the complete file is hashed. Sampling needs at least two blocks,
+    such that the start and end of the file are always included.
+    """
+
+    if not full and nblocks < 2:
+        raise ValueError("nblocks should be at least 2..")
+
+    size = os.path.getsize(file)
+    h = hashlib.blake2b(str(size).encode(), digest_size = 16)
+    with open(file, "rb") as f:
+        if full or size <= nblocks * blocksize:
+            for block in iter(functools.partial(f.read, blocksize), b""):
+                h.update(block)
+        else:
+            step = (size - blocksize) // (nblocks - 1)
+            for i in range(nblocks):
+                f.seek(i * step)
+                h.update(f.read(blocksize))
+
+    return h.hexdigest()
+
+
+class FingerprintIndex(object):
+
+    """
+    Persistent index of file fingerprints in a small sqlite database. Hashes
+    are cached by device, inode, size and mtime, such that repeated scans
+    only cost a stat call per file, and renamed files are recognised without
+    hashing. Files that were moved to another device are rehashed and can
+    be found by their fingerprint.
+
+    Parameters
+    ----------
+    dbfile : str
+        Database file, created if it does not exist
+    full : bool, default = False
+        If files should be fully hashed instead of sampled
+    workers : int, default = 4
+        Number of threads to hash files in parallel
+    """
+
+    def __init__(self, dbfile, full = False, workers = 4):
+
+        import sqlite3
+
+        self.full = full
+        self.method = "full" if full else "sample"
+        self.workers = workers
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                           dev INTEGER, inode INTEGER, method TEXT,
+                           size INTEGER, mtime INTEGER, path TEXT, hash TEXT,
+                           PRIMARY KEY (dev, inode, method))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hashes ON files (hash)")
+        self.db.commit()
+
+    def _cached(self, path, stat):
+
+        row = self.db.execute("""SELECT size, mtime, path, hash FROM files
+                                 WHERE dev = ? AND inode = ? AND method = ?""",
+                              (stat.st_dev, stat.st_ino, self.method)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        if row[2] != path:
+            self._store(path, stat, row[3])
+
+        return row[3]
+
+    def _store(self, path, stat, hash):
+
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)",
+                        (stat.st_dev, stat.st_ino, self.method, stat.st_size,
+                         stat.st_mtime_ns, path, hash))
+
+    def get(self, file):
+
+        """Returns the fingerprint of a file, from the index if unchanged"""
+
+        return self.scan([file])[os.path.abspath(file)]
+
+    def scan(self, files):
+
+        """
+        Returns a dict with the fingerprints of a list of files, hashing the
+        files that are new or changed in parallel
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        hashes, todo = {}, []
+        for file in files:
+            path = os.path.abspath(file)
+            stat = os.stat(path)
+            hash = self._cached(path, stat)
+            if hash is None:
+                todo.append((path, stat))
+            else:
+                hashes[path] = hash
+
+        with ThreadPoolExecutor(max_workers = max(self.workers, 1)) as pool:
+            newhashes = pool.map(lambda t: fingerprint(t[0], self.full), todo)
+            for (path, stat), hash in zip(todo, newhashes):
+                self._store(path, stat, hash)
+                hashes[path] = hash
+        self.db.commit()
+
+        return hashes
+
+    def lookup(self, hash):
+
+        """Returns the known paths of files with a fingerprint"""
+
+        rows = self.db.execute("""SELECT path FROM files WHERE hash = ? AND
+                                  method = ?""", (hash, self.method))
+
+        return sorted(row[0] for row in rows)
+
+    def duplicates(self):
+
+        """Returns a dict of fingerprints with the paths of duplicate files"""
+
+        rows = self.db.execute("""SELECT hash, path FROM files WHERE method = ?
+                                  AND hash IN (SELECT hash FROM files WHERE
+                                  method = ? GROUP BY hash HAVING COUNT(*) > 1)
+                                  ORDER BY hash, path""",
+                               (self.method, self.method))
+        dups = {}
+        for hash, path in rows:
+            dups.setdefault(hash, []).append(path)
+
+        return dups
+
+    def prune(self):
+
+        """Removes files that no longer exist or changed from the index"""
+
+        rows = self.db.execute("""SELECT dev, inode, size, mtime, path
+                                  FROM files""").fetchall()
+        stale = []
+        for dev, inode, size, mtime, path in rows:
+            try:
+                stat = os.stat(path)
+                current = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = None
+            if current != (dev, inode, size, mtime):
+                stale.append((dev, inode))
+        self.db.executemany("DELETE FROM files WHERE dev = ? AND inode = ?",
+                            stale)
+        self.db.commit()
+
+        return len(stale)
+
+    def close(self):
+
+        self.db.close()
+
+
 def get_ext(filename):
 
     """Returns file extension in lower case"""
@@ -162,31 +915,173 @@ def get_ext(filename):
     return os.path.splitext(str(filename))[-1].lower()
 
 
+_ymlcache = {}
+_YmlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _parseyml(filename):
+
+    """
+    Returns the parsed content of a .yml file, cached until the file's mtime
+    or size changes. The cached object should not be modified.
+    """
+
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _ymlcache.get(filename)
+    if cached is None or cached[0] != key:
+        with open(filename) as f:
+            cached = (key, yaml.load(f, Loader=_YmlLoader))
+        _ymlcache[filename] = cached
+
+    return cached[1]
+
+
+def _literal(value):
+
+    """Evaluates a string to a python literal if possible"""
+
+    if isinstance(value, str):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+
+    return value
+
+
 def loadyml(filename, value = None, add = True):
 
     """Loads value from .yml file and returns literal"""
 
     if os.path.exists(filename):
-        with open(filename) as f:
-            newvalue = yaml.load(f)
+        newvalue = copy.deepcopy(_parseyml(filename))
         if value is not None:
             newvalue = newvalue + value if add else value
     else:
         newvalue = value
-    newvalue = ast.literal_eval(str(newvalue))
 
-    return newvalue
+    return _literal(newvalue)
 
 
-def loadh5data(filename, dataset = "data"):
+def getyml(filename, key, default = None):
 
-    import h5py
+    """
+    Returns a single value from a .yml file as literal by key, or by a list
+    of keys for nested values, using the cached parsed file
+    """
+
+    value = _parseyml(filename)
+    for k in (key if isinstance(key, (list, tuple)) else [key]):
+        try:
+            value = value[k]
+        except (KeyError, IndexError, TypeError):
+            return default
+
+    return _literal(copy.deepcopy(value))
+
+
+@contextlib.contextmanager
+def _h5open(filename):
+
+    """Opens an hdf5 file, or uses an already opened h5py file or group"""
+
+    if isinstance(filename, (str, bytes, os.PathLike)):
+        import h5py
+        with h5py.File(filename, 'r') as h5file:
+            yield h5file
+    else:
+        yield filename
+
+
+def _h5read(dataset, start = None, stop = None, columns = None):
+
+    """Reads a row range and optionally a subset of columns of a dataset"""
+
+    import numpy
     import pandas
-    h5file = h5py.File(filename, 'r')
-    dataset = pandas.DataFrame(h5file[dataset][:])
-    h5file.close()
 
-    return dataset
+    rows = slice(start, stop)
+    if columns is None:
+        return pandas.DataFrame(dataset[rows])
+    columns = [columns] if numpy.isscalar(columns) else list(columns)
+    if dataset.dtype.names is not None:
+        return pandas.DataFrame(dataset.fields(columns)[rows])
+
+    # h5py needs unique, increasing column indices
+    unique, inverse = numpy.unique(columns, return_inverse = True)
+    data = dataset[rows, unique.tolist()][:, inverse.ravel()]
+
+    return pandas.DataFrame(data, columns = columns)
+
+
+def loadh5data(filename, dataset = "data", start = None, stop = None,
+               columns = None):
+
+    """
+    Loads a dataset from an hdf5 file as pandas dataframe
+
+    Parameters
+    ----------
+    filename : str or open h5py file
+    dataset : str or list of str, default = "data"
+        Name of the dataset. If a list, a dict of dataframes is returned that
+        are all read through one open file handle.
+    start, stop : int, default = None
+        Range of rows to read
+    columns : list, default = None
+        Field names of a compound dataset or column indices of a 2d dataset
+        to read. If None, all columns are read.
+    """
+
+    with _h5open(filename) as h5file:
+        if isinstance(dataset, str):
+            return _h5read(h5file[dataset], start, stop, columns)
+
+        return {name: _h5read(h5file[name], start, stop, columns)
+                for name in dataset}
+
+
+def iterh5data(filename, dataset = "data", chunksize = 100000, start = None,
+               stop = None, columns = None):
+
+    """
+    Yields a dataset from an hdf5 file as pandas dataframes of chunksize rows,
+    with the same options as loadh5data
+    """
+
+    with _h5open(filename) as h5file:
+        data = h5file[dataset]
+        start = 0 if start is None else start
+        stop = len(data) if stop is None else min(stop, len(data))
+        for i in range(start, stop, chunksize):
+            yield _h5read(data, i, min(i + chunksize, stop), columns)
+
+
+def h5dataset(filename, dataset = "data", mmap = False):
+
+    """
+    Returns a dataset from an hdf5 file without reading it into memory,
+    either as h5py dataset, of which the file should be closed with
+    dataset.file.close(), or as read-only numpy memmap if mmap is True. A
+    memmap is only possible for contiguous, uncompressed datasets.
+    """
+
+    import h5py
+    import numpy
+
+    if not mmap:
+        return h5py.File(filename, 'r')[dataset]
+
+    with h5py.File(filename, 'r') as h5file:
+        data = h5file[dataset]
+        offset = data.id.get_offset()
+        if offset is None or data.chunks is not None:
+            raise ValueError("Dataset is chunked or empty and cannot be memmapped..")
+        dtype, shape = data.dtype, data.shape
+
+    return numpy.memmap(filename, dtype = dtype, mode = 'r', offset = offset,
+                        shape = shape)
 
 
 def name(filename, ext = "", action = "newfile"):
@@ -213,6 +1108,82 @@ def name(filename, ext = "", action = "newfile"):
     elif action == "newfile":
         names = [os.path.splitext(x)[0] for x in names]
         suffixes = [x.replace(filename, '') for x in names]
-        suffixes = [int(x[1]) for x in suffixes if x.startswith('_')]
+        suffixes = [int(x[1:]) for x in suffixes if re.fullmatch(r"_\d+", x)]
         suffix = 2 if len(suffixes)==0 else max(suffixes)+1
         return '%s_%d%s' % (filename, suffix, ext)
+
+
+class NameAllocator(object):
+
+    """
+    Allocates sequential file names (name.ext, name_2.ext, name_3.ext, ..)
+    that are safe to use by multiple threads and processes at the same time.
+    Names are claimed by atomically creating an empty file with O_EXCL, and
+    the highest sequence number per directory, name and extension is cached
+    such that the directory is only listed once.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._seqs = {}
+
+    def _scan(self, dirname, filename, ext):
+
+        """Returns the highest sequence number in use, 1 for name.ext"""
+
+        pattern = re.compile(re.escape(filename) + r"(?:_(\d+))?" + re.escape(ext))
+        seq = 0
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                match = pattern.fullmatch(entry.name)
+                if match:
+                    seq = max(seq, int(match.group(1) or 1))
+
+        return seq
+
+    def claim(self, filename, ext = ""):
+
+        """
+        Claims the next free name for a file with required extension by
+        creating it, and returns its path
+        """
+
+        dirname, filename = os.path.split(filename)
+        filename = os.path.splitext(filename)[0]
+        key = (os.path.abspath(dirname), filename, ext)
+
+        with self._lock:
+            seq = self._seqs.get(key)
+            if seq is None:
+                seq = self._scan(dirname or '.', filename, ext)
+            while True:
+                seq = max(seq + 1, 1)
+                newname = filename+ext if seq == 1 else '%s_%d%s' % (filename, seq, ext)
+                path = os.path.join(dirname, newname)
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    continue
+                self._seqs[key] = seq
+                return path
+
+    def reset(self):
+
+        """Clears the cached sequence numbers"""
+
+        with self._lock:
+            self._seqs.clear()
+
+
+_allocator = NameAllocator()
+
+
+def claimname(filename, ext = ""):
+
+    """
+    Claims the next free sequential name for a file with required extension,
+    safe for parallel writers, by creating it. See NameAllocator.
+    """
+
+    return _allocator.claim(filename, ext)
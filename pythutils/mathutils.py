@@ -5,8 +5,12 @@
 from __future__ import division
 
 import math
+import bisect
 import numpy as np
 
+from functools import lru_cache
+from collections import deque
+
 def uneven(value):
 
     """Returns the closest uneven value equal to or lower than provided"""
@@ -50,6 +54,41 @@ def seqcount(start, stop, steplength):
     return sequence
 
 
+@lru_cache(maxsize = 4096)
+def divisors(n):
+
+    """Returns the sorted divisors of a positive integer in O(sqrt(n))"""
+
+    n = int(n)
+    if n < 1:
+        raise ValueError("Value should be a positive integer..")
+
+    small, large = [], []
+    for i in range(1, math.isqrt(n) + 1):
+        if n % i == 0:
+            small.append(i)
+            if i != n // i:
+                large.append(n // i)
+
+    return tuple(small + large[::-1])
+
+
+@lru_cache(maxsize = 4096)
+def _maxsteps(value, maxval):
+
+    nsteps, stepsize = 1, value
+    for val in range(value-3, value+1):
+        if val < 1:
+            continue
+        divs = divisors(val)
+        i = bisect.bisect_left(divs, maxval) - 1
+        if i >= 0 and divs[i] > nsteps:
+            nsteps = divs[i]
+            stepsize = val // nsteps
+
+    return nsteps, stepsize
+
+
 def maxsteps(value, maxval = 500):
 
     """
@@ -57,19 +96,38 @@ def maxsteps(value, maxval = 500):
     divided up to a maximum value, all being rounded value. For example, if one
     wants to get the maximum number of steps to get to a value of 100 where it
     can be maximally divided 7 times, it will return nsteps=5, stepsize=20.
+    If none of the values can be divided, it returns nsteps=1, stepsize=value.
+
+    Also accepts an array of values, in which case arrays of nsteps and
+    stepsize are returned. Results are memoized.
     """
 
-    valrange = [value-3,value-2,value-1,value]
-    nsteps = 1
-    for val in valrange:
-        for _,n in enumerate(reversed(list(range(1, maxval)))):
-            if val % n == 0:
-                if n > nsteps:
-                    nsteps = int(n)
-                    stepsize = int(val/nsteps)
-                break
+    if np.ndim(value) > 0:
+        values = np.asarray(value, dtype = np.int64)
+        uniq, inv = np.unique(values, return_inverse = True)
+        steps = np.array([_maxsteps(int(v), maxval) for v in uniq],
+                         dtype = np.int64).reshape(-1, 2)
+        steps = steps[inv.reshape(values.shape)]
+        return steps[..., 0], steps[..., 1]
+
+    return _maxsteps(int(value), maxval)
 
-    return(nsteps, stepsize)
+
+@lru_cache(maxsize = 128)
+def weight_kernel(w = 1.7, length = 20):
+
+    """
+    Returns a cached, read-only array of weights based on quadratic function,
+    ordered from the most recent to the oldest value
+    """
+
+    if length < 1:
+        raise ValueError("length should be at least 1..")
+
+    kernel = np.power(float(w), np.arange(length, 0, -1))
+    kernel.flags.writeable = False
+
+    return kernel
 
 
 def get_weights(w = 1.7, length = 20):
@@ -79,6 +137,85 @@ def get_weights(w = 1.7, length = 20):
     return [w**i for i in range(length, 0, -1)]
 
 
+def weighted_smooth(values, w = 1.7, length = 20, causal = False):
+
+    """
+    Smooths a series or (N,C) array of values with the weights from
+    weight_kernel by convolution. Missing values are ignored in the weighted
+    average of their neighbours and remain NaN in the output.
+
+    causal : bool, default = False
+        If only the current and previous values should be used, such that
+        the result is the same as when smoothing a live stream of values. If
+        False, a symmetric kernel around the current value is used.
+    """
+
+    kernel = weight_kernel(w, length)
+    if not causal:
+        kernel = np.concatenate((kernel[:0:-1], kernel))
+
+    values = np.asarray(values, dtype = float)
+    if len(values) == 0:
+        return values.copy()
+    flat = values.reshape(len(values), -1)
+    valid = ~np.isnan(flat)
+    smoothed = np.empty_like(flat)
+
+    for c in range(flat.shape[1]):
+        if causal:
+            num = np.convolve(np.where(valid[:, c], flat[:, c], 0), kernel)
+            den = np.convolve(valid[:, c], kernel)
+            num, den = num[:len(flat)], den[:len(flat)]
+        else:
+            num = np.convolve(np.where(valid[:, c], flat[:, c], 0), kernel)
+            den = np.convolve(valid[:, c], kernel)
+            num = num[length-1:length-1+len(flat)]
+            den = den[length-1:length-1+len(flat)]
+        smoothed[:, c] = np.where(valid[:, c], num / np.where(valid[:, c], den, 1),
+                                  np.nan)
+
+    return smoothed.reshape(values.shape)
+
+
+class WeightedSmoother(object):
+
+    """
+    Causal weighted smoothing of live streams of values, kept per id. Gives
+    the same results as weighted_smooth with causal=True.
+    """
+
+    def __init__(self, w = 1.7, length = 20):
+
+        self.kernel = weight_kernel(w, length)
+        self.buffers = {}
+
+    def update(self, value, id = None):
+
+        """Adds a new value for an id and returns its smoothed value"""
+
+        buf = self.buffers.get(id)
+        if buf is None:
+            buf = self.buffers[id] = deque(maxlen = len(self.kernel))
+        value = np.asarray(value, dtype = float)
+        buf.appendleft(value)
+        if np.isnan(value).all():
+            return value
+
+        values = np.array(buf)
+        valid = ~np.isnan(values)
+        kernel = self.kernel[:len(buf)].reshape((-1,) + (1,) * value.ndim)
+        num = (np.where(valid, values, 0) * kernel).sum(axis = 0)
+        den = (valid * kernel).sum(axis = 0)
+
+        return np.where(np.isnan(value), np.nan, num / np.where(den > 0, den, 1))
+
+    def reset(self, id = None):
+
+        """Clears the buffered values of an id"""
+
+        self.buffers.pop(id, None)
+
+
 def sort_twoPoint(coords):
 
     """Fixes the coordinates of a two-point to be LT to BR"""
@@ -91,36 +228,93 @@ def sort_twoPoint(coords):
     return ((x1,y1),(x2,y2))
 
 
-def sort_points(pts):
+def sort_points(pts, out = None):
 
     """
     Initializes a list of coordinates that will be ordered from top-left to
-    bottom-left in clockwise order
+    bottom-left in clockwise order. Also accepts a (K,4,2) array of K
+    quadrilaterals, which are all sorted in one vectorized call.
+
+    out : array, default = None
+        Optional float32 array of the same shape to hold the result
     """
 
-    rect = np.zeros((4, 2), dtype = "float32")
-    s = pts.sum(axis = 1)
-    rect[0] = pts[np.argmin(s)]
-    rect[2] = pts[np.argmax(s)]
-    diff = np.diff(pts, axis = 1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
+    pts = np.asarray(pts)
+    s = pts.sum(axis = -1)
+    diff = pts[..., 1] - pts[..., 0]
+    idx = np.stack([np.argmin(s, axis = -1), np.argmin(diff, axis = -1),
+                    np.argmax(s, axis = -1), np.argmax(diff, axis = -1)], axis = -1)
+    rect = np.take_along_axis(pts, idx[..., None], axis = -2)
+
+    if out is None:
+        return rect.astype("float32")
+    out[...] = rect
 
-    return rect
+    return out
+
+
+_SCALARS = (int, float, np.number, type(None))
+
+
+def _xy(pt):
+
+    """
+    Returns the x and y coordinate(s) of a point, an (N,2) array or list of
+    points or a tuple of an x and a y array, and if they are arrays
+    """
+
+    if isinstance(pt, (tuple, list)) and len(pt) == 2 and \
+       isinstance(pt[0], _SCALARS) and isinstance(pt[1], _SCALARS):
+        return pt[0], pt[1], False
+    if isinstance(pt, np.ndarray):
+        if pt.ndim > 1:
+            return pt[..., 0], pt[..., 1], True
+        return pt[0], pt[1], False
+
+    if isinstance(pt, tuple) and len(pt) == 2 and \
+       all(isinstance(c, np.ndarray) and c.ndim == 1 for c in pt):
+        return pt[0], pt[1], True
+    try:
+        arr = np.asarray(pt, dtype = float)
+    except (TypeError, ValueError):
+        return pt[0], pt[1], False
+    if arr.ndim == 2:
+        return arr[:, 0], arr[:, 1], True
+
+    return pt[0], pt[1], False
+
+
+def _points(pt1, pt2):
+
+    """
+    Returns the x and y coordinate(s) of two points, as float arrays if
+    either of them is a batch, and if they are arrays
+    """
+
+    x1, y1, batch1 = _xy(pt1)
+    x2, y2, batch2 = _xy(pt2)
+    if batch1 or batch2:
+        x1, y1, x2, y2 = [np.asarray(c, dtype = float) for c in (x1,y1,x2,y2)]
+        return x1, y1, x2, y2, True
+
+    return x1, y1, x2, y2, False
 
 
 def points_to_vec(pt1, pt2, flip = False):
 
     """
-    Converts the coordinate of two points (pt1 > pt2) to a vector
+    Converts the coordinate of two points (pt1 > pt2) to a vector. Also accepts
+    (N,2) arrays or lists of points or tuples of x and y arrays, in which case
+    arrays of vx and vy are returned.
 
     flip: bool, default = False
         If the coordinate system should be flipped such that higher y-coords
         are lower (e.g. needed when working with images in opencv).
     """
 
-    vx = pt2[0] - pt1[0]
-    vy = pt1[1] - pt2[1] if flip else pt2[1] - pt1[1]
+    x1, y1, x2, y2, _ = _points(pt1, pt2)
+    vx = x2 - x1
+    vy = y1 - y2 if flip else y2 - y1
 
     return vx, vy
 
@@ -129,7 +323,8 @@ def angle_to_vec(angle):
 
     """
     Converts an angle in degrees to a vector. Uses a coordinate system that
-    points north and ranges from -180 to 180 degrees.
+    points north and ranges from -180 to 180 degrees. Also accepts an array
+    of angles, in which case arrays of vx and vy are returned.
     """
 
     vx = np.round(np.sin(np.radians(angle)), 3)
@@ -143,14 +338,23 @@ def points_to_angle(pt1, pt2 = None, flip = False):
     """
     Returns the angle of a vector from the origin to a single point or the angle
     between two points. Uses a coordinate system that points north and ranges
-    from -180 to 180 degrees.
+    from -180 to 180 degrees. Also accepts (N,2) arrays or lists of points or
+    tuples of x and y arrays, in which case an array of angles is returned with
+    NaN for rows with missing coordinates.
 
     flip: bool, default = False
         If the coordinate system should be flipped such that higher y-coords
         are lower (e.g. needed when working with images in opencv).
     """
 
-    vx, vy = pt1 if pt2 is None else points_to_vec(pt1, pt2, flip)
+    if pt2 is None:
+        vx, vy, batch = _xy(pt1)
+        if batch:
+            vx, vy = np.asarray(vx, dtype = float), np.asarray(vy, dtype = float)
+    else:
+        x1, y1, x2, y2, _ = _points(pt1, pt2)
+        vx = x2 - x1
+        vy = y1 - y2 if flip else y2 - y1
     angle = np.round(np.arctan2(vx, vy) * 180 / np.pi,2)
 
     return angle
@@ -158,23 +362,42 @@ def points_to_angle(pt1, pt2 = None, flip = False):
 
 def midpoint(pt1, pt2):
 
-    """Computes the midpoint between two points"""
+    """
+    Computes the midpoint between two points. Also accepts (N,2) arrays, lists
+    of points or tuples of x and y arrays, in which case an (N,2) array of
+    midpoints is returned with NaN for rows with missing coordinates.
+    """
+
+    x1, y1, x2, y2, batch = _points(pt1, pt2)
+    if batch:
+        x = x2 + np.trunc((x1 - x2) / 2)
+        y = y2 + np.trunc((y1 - y2) / 2)
+        mid = np.stack(np.broadcast_arrays(x, y), axis = -1)
+        mid[np.isnan(mid).any(axis = -1)] = np.nan
+        return mid
 
-    x = pt2[0]+int((pt1[0]-pt2[0])/2)
-    y = pt2[1]+int((pt1[1]-pt2[1])/2)
+    x = x2+int((x1-x2)/2)
+    y = y2+int((y1-y2)/2)
 
     return (x,y)
 
 
 def ptsToDist(pt1, pt2):
 
-    """Computes the distance between two points"""
+    """
+    Computes the distance between two points. Also accepts (N,2) arrays, lists
+    of points or tuples of x and y arrays, in which case an array of distances
+    is returned with NaN for rows with missing coordinates.
+    """
 
-    if None in pt1 or None in pt2:
+    x1, y1, x2, y2, batch = _points(pt1, pt2)
+    if batch:
+        return np.hypot(x2 - x1, y2 - y1)
+
+    if None in (x1, y1) or None in (x2, y2):
         dist = None
     else:
-        vx, vy = points_to_vec(pt1, pt2)
-        dist = np.linalg.norm([(vx, vy)])
+        dist = np.linalg.norm([(x2 - x1, y2 - y1)])
 
     return dist
 
@@ -203,8 +426,8 @@ def dist_to_segment(pt, segment):
 
     Input
     ----------
-    point : tuple of the point's coordinates
-    line : tuple of segment endpoints' coordinates
+    pt : tuple of the point's coordinates
+    segment : tuple of segment endpoints' coordinates
 
     Returns
     -------
@@ -218,7 +441,9 @@ def dist_to_segment(pt, segment):
     norm_uline = uline / np.linalg.norm(uline)
 
     # compute the perpendicular distance to the theoretical infinite line
-    dott_product = np.cross(segment[1] - segment[0], segment[0] - pt)
+    pt = np.array(pt)
+    dott_product = uline[0] * (segment[0][1] - pt[1]) - \
+                   uline[1] * (segment[0][0] - pt[0])
     dist_infline = (np.linalg.norm(dott_product / np.linalg.norm(uline)))
     diff = (norm_uline[0] * (pt[0] - segment[0][0])) + \
            (norm_uline[1] * (pt[1] - segment[0][1]))
@@ -230,24 +455,267 @@ def dist_to_segment(pt, segment):
     endpoint_dist = min(linept1dis, linept2dis)
 
     # decide if the intersection point falls on the line segment
-    lp1_x = line[0][0]
-    lp1_y = line[0][1]
-    lp2_x = line[1][0]
-    lp2_y = line[1][1]
-    is_betw_x = lp1_x <= x_seg <= lp2_x or lp2_x <= x_seg <= lp1_x
-    is_betw_y = lp1_y <= y_seg <= lp2_y or lp2_y <= y_seg <= lp1_y
-
-    if is_betw_x and is_betw_y:
+    is_betw = 0 <= diff <= np.linalg.norm(uline)
+
+    if is_betw:
         dist = dist_infline
         coords = (x_seg, y_seg)
     else:
         # if not, then return the minimum distance to the segment endpoints
         dist = endpoint_dist
-        coords = (line[0][0],line[0][1]) if linept1dis<=linept2dis else (line[1][0],line[1][1])
+        coords = (segment[0][0],segment[0][1]) if linept1dis<=linept2dis else (segment[1][0],segment[1][1])
+
+    return dist, coords
+
+
+def _segments_to_array(segments):
+
+    """Converts a segment or list of segments to an (M,2,2) float array"""
+
+    return np.asarray(segments, dtype = float).reshape(-1, 2, 2)
+
+
+def _segdist(pts, segments):
+
+    """
+    Point-to-segment distances and closest coordinates for (...,2) pts and
+    (...,2,2) segments that broadcast against each other
+    """
+
+    start = segments[..., 0, :]
+    uline = segments[..., 1, :] - start
+    seglen2 = (uline ** 2).sum(axis = -1)
+
+    # project onto the infinite line and clip the projection to the segment
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        proj = ((pts - start) * uline).sum(axis = -1) / seglen2
+    proj = np.where(seglen2 > 0, np.clip(proj, 0, 1), 0)
+
+    coords = start + proj[..., None] * uline
+    dist = np.hypot(pts[..., 0] - coords[..., 0], pts[..., 1] - coords[..., 1])
+
+    return dist, coords
+
+
+def _dist_to_segments(pts, segments):
+
+    """Distances between all (N,2) pts and all (M,2,2) segments"""
+
+    return _segdist(pts[:, None, :], segments[None, :, :, :])
+
+
+def dist_to_segments(pts, segments, chunksize = None):
+
+    """
+    Calculates the distances between N points and M line segments in a single
+    broadcasted computation, the batched equivalent of dist_to_segment
+
+    Input
+    ----------
+    pts : (N,2) array of point coordinates
+    segments : (M,2,2) array of segment endpoints' coordinates
+    chunksize : int, default = None
+        Number of points to process at once to keep the temporary arrays of
+        size chunksize x M. If None, all points are processed at once.
+
+    Returns
+    -------
+    dist : (N,M) array of minimum distances of each point to each segment
+    coords : (N,M,2) array of closest point coordinates on each segment. Unlike
+        dist_to_segment these are not rounded.
+    """
+
+    pts = np.asarray(pts, dtype = float).reshape(-1, 2)
+    segments = _segments_to_array(segments)
+
+    if chunksize is None or chunksize >= len(pts):
+        return _dist_to_segments(pts, segments)
+
+    dist = np.empty((len(pts), len(segments)))
+    coords = np.empty((len(pts), len(segments), 2))
+    for start, cdist, ccoords in dist_to_segments_chunks(pts, segments,
+                                                         chunksize):
+        dist[start:start+len(cdist)] = cdist
+        coords[start:start+len(cdist)] = ccoords
 
     return dist, coords
 
 
+def dist_to_segments_chunks(pts, segments, chunksize = 10000):
+
+    """
+    Generator version of dist_to_segments that yields the start index, the
+    distances and closest coordinates for consecutive chunks of points, such
+    that memory stays bounded for large numbers of points and segments
+    """
+
+    if chunksize < 1:
+        raise ValueError("chunksize should be at least 1..")
+
+    pts = np.asarray(pts, dtype = float).reshape(-1, 2)
+    segments = _segments_to_array(segments)
+
+    for start in range(0, len(pts), chunksize):
+        dist, coords = _dist_to_segments(pts[start:start+chunksize], segments)
+        yield start, dist, coords
+
+
+def _expand_ranges(starts, counts):
+
+    """
+    Expands a set of ranges, given by their starts and counts, to a flat array
+    of values and the array of the range each value belongs to
+    """
+
+    owner = np.repeat(np.arange(len(counts)), counts)
+    ends = np.cumsum(counts)
+    local = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends-counts, counts)
+
+    return owner, starts[owner] + local
+
+
+class SegmentGrid(object):
+
+    """
+    Uniform grid spatial index over a set of line segments, built once to answer
+    nearest-segment and within-radius queries for batches of points. Distances
+    are the same as those of dist_to_segment and dist_to_segments.
+
+    Parameters
+    ----------
+    segments : (M,2,2) array of segment endpoints' coordinates
+    cellsize : float, default = None
+        Size of the grid cells. If None, it is based on the mean segment length
+        and the density of the segments.
+    """
+
+    def __init__(self, segments, cellsize = None):
+
+        self.segments = _segments_to_array(segments)
+        if len(self.segments) == 0:
+            raise ValueError("No segments provided..")
+
+        endpts = self.segments.reshape(-1, 2)
+        self.origin = endpts.min(axis = 0)
+        extent = endpts.max(axis = 0) - self.origin
+
+        if cellsize is None:
+            uline = self.segments[:, 1] - self.segments[:, 0]
+            meanlen = np.hypot(uline[:, 0], uline[:, 1]).mean()
+            cellsize = max(meanlen, np.sqrt(np.prod(extent)/len(self.segments)))
+        self.cellsize = float(cellsize) if cellsize > 0 else 1.
+        self.shape = (extent // self.cellsize).astype(int) + 1
+
+        # register each segment in all cells overlapped by its bounding box
+        lo = self._cell(self.segments.min(axis = 1))
+        hi = self._cell(self.segments.max(axis = 1))
+        segids, cellids = self._cellpairs(lo, hi, np.ones(len(lo), bool))
+        order = np.argsort(cellids, kind = "stable")
+        self._segids = segids[order]
+        ncells = int(np.prod(self.shape))
+        self._offsets = np.zeros(ncells + 1, dtype = np.int64)
+        np.cumsum(np.bincount(cellids, minlength = ncells),
+                  out = self._offsets[1:])
+
+    def __len__(self):
+
+        return len(self.segments)
+
+    def _cell(self, pts):
+
+        return np.floor((pts - self.origin) / self.cellsize).astype(np.int64)
+
+    def _cellpairs(self, lo, hi, valid):
+
+        """Returns (item, cell id) pairs for the cell ranges lo to hi"""
+
+        lo = np.clip(lo, 0, self.shape - 1)
+        hi = np.clip(hi, 0, self.shape - 1)
+        nx = hi[:, 0] - lo[:, 0] + 1
+        counts = np.where(valid, nx * (hi[:, 1] - lo[:, 1] + 1), 0)
+        owner, local = _expand_ranges(np.zeros(len(counts), np.int64), counts)
+        cx = lo[owner, 0] + local % nx[owner]
+        cy = lo[owner, 1] + local // nx[owner]
+
+        return owner, cy * self.shape[0] + cx
+
+    def _candidates(self, pts, radius):
+
+        """Returns unique (point, segment) pairs from cells within radius"""
+
+        with np.errstate(invalid = "ignore"):
+            valid = ~np.isnan(pts).any(axis = 1)
+            lo = np.floor((np.nan_to_num(pts) - radius - self.origin) / self.cellsize)
+            hi = np.floor((np.nan_to_num(pts) + radius - self.origin) / self.cellsize)
+        valid &= ((hi >= 0) & (lo <= self.shape - 1)).all(axis = 1)
+        lo = np.clip(lo, -1, self.shape).astype(np.int64)
+        hi = np.clip(hi, -1, self.shape).astype(np.int64)
+        ptids, cellids = self._cellpairs(lo, hi, valid)
+
+        starts = self._offsets[cellids]
+        counts = self._offsets[cellids + 1] - starts
+        pair, loc = _expand_ranges(starts, counts)
+        pairs = np.unique(ptids[pair] * len(self.segments) + self._segids[loc])
+
+        return pairs // len(self.segments), pairs % len(self.segments)
+
+    def within(self, pts, radius):
+
+        """
+        Finds all segments within a radius of each point
+
+        Returns
+        -------
+        ptidx : array of point indices, sorted
+        segidx : array of segment indices for each point
+        dist : array of distances between the point and the segment
+        """
+
+        pts = np.asarray(pts, dtype = float).reshape(-1, 2)
+        ptidx, segidx = self._candidates(pts, radius)
+        dist, _ = _segdist(pts[ptidx], self.segments[segidx])
+        keep = dist <= radius
+
+        return ptidx[keep], segidx[keep], dist[keep]
+
+    def nearest(self, pts):
+
+        """
+        Finds the nearest segment for each point, by searching in increasingly
+        large radii around the point. Points with missing coordinates return a
+        distance of NaN and segment index of -1.
+
+        Returns
+        -------
+        dist : (N,) array of distances to the nearest segment
+        segidx : (N,) array of nearest segment indices
+        coords : (N,2) array of the closest point coordinates on the segment
+        """
+
+        pts = np.asarray(pts, dtype = float).reshape(-1, 2)
+        dist = np.full(len(pts), np.nan)
+        segidx = np.full(len(pts), -1, dtype = np.int64)
+        coords = np.full((len(pts), 2), np.nan)
+
+        todo = np.flatnonzero(~np.isnan(pts).any(axis = 1))
+        radius = self.cellsize
+        while len(todo) > 0:
+            ptidx, segs, d = self.within(pts[todo], radius)
+            if len(ptidx) > 0:
+                order = np.lexsort((segs, d, ptidx))
+                first = order[np.r_[True, np.diff(ptidx[order]) > 0]]
+                found = todo[ptidx[first]]
+                dist[found] = d[first]
+                segidx[found] = segs[first]
+                todo = np.delete(todo, ptidx[first])
+            radius *= 2
+
+        valid = segidx >= 0
+        _, coords[valid] = _segdist(pts[valid], self.segments[segidx[valid]])
+
+        return dist, segidx, coords
+
+
 def maxrect(dims, maxdims = (1640,1232), decimals = 2):
 
     """
@@ -7,6 +7,9 @@ from __future__ import print_function
 
 import os
 import cv2
+import json
+import queue
+import threading
 import numpy as np
 
 from pythutils.fileutils import get_ext
@@ -84,6 +87,126 @@ def get_vid_params(mediafile):
     return fps, width, height, fcount
 
 
+class FrameReader(object):
+
+    """
+    Reads frames from a video file or stream in a background thread, such
+    that decoding overlaps with processing. Iterating over it gives
+    (frame_index, frame) pairs.
+
+    Parameters
+    ----------
+    source : str or int
+        Video file or stream
+    prefetch : int, default = 32
+        Maximum number of frames decoded ahead
+    step : int, default = 1
+        Only returns every step-th frame, the others are grabbed without
+        decoding
+    start : int, default = 0
+        Frame to start reading from
+    gray : bool, default = False
+        If frames should be converted to grayscale
+    resize : float or tuple, default = None
+        Resize value or (width, height) dimensions to resize frames to
+    """
+
+    _END = object()
+
+    def __init__(self, source, prefetch = 32, step = 1, start = 0, gray = False,
+                 resize = None):
+
+        self.source = source
+        self.step = max(int(step), 1)
+        self.gray = gray
+        self.resize = resize
+        self.cap = cv2.VideoCapture(source)
+        if not self.cap.isOpened():
+            raise RuntimeError("Video could not be opened..")
+        if start > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        self.index = start
+
+        self.queue = queue.Queue(maxsize = max(int(prefetch), 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self._read, daemon = True)
+        self.thread.start()
+
+    def __iter__(self):
+
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout = 0.1)
+                except queue.Empty:
+                    if self.stopped.is_set() or not self.thread.is_alive():
+                        break
+                    continue
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+
+        self.stop()
+
+    def _put(self, item):
+
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _convert(self, frame):
+
+        if self.gray and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.resize is not None:
+            if isinstance(self.resize, (tuple, list)):
+                frame = imgresize(frame, dims = tuple(self.resize))
+            elif self.resize != 1:
+                frame = imgresize(frame, self.resize)
+
+        return frame
+
+    def _read(self):
+
+        try:
+            while not self.stopped.is_set():
+                flag, frame = self.cap.read()
+                if not flag or not self._put((self.index, self._convert(frame))):
+                    return
+                self.index += 1
+                for _ in range(self.step - 1):
+                    if not self.cap.grab():
+                        return
+                    self.index += 1
+        except Exception as error:
+            self._put(error)
+        finally:
+            self.cap.release()
+            self._put(self._END)
+
+    def stop(self):
+
+        """Stops reading and releases the video"""
+
+        self.stopped.set()
+        self.thread.join()
+
+
 def videowriter(filein, w, h, fps, resizeval = 1):
     """Creates a cv2.VideoWriter object and checks if it opened successfully"""
     from pythutils.fileutils import get_ext
@@ -102,23 +225,109 @@ def videowriter(filein, w, h, fps, resizeval = 1):
     return vidout
 
 
-def safe_framecount(vidfile):
+def _countframes(vidfile):
 
-    """Saves video frame counter that counts frame-by-frame"""
+    """Returns the number of grabbed and the reported number of frames"""
 
     cap = cv2.VideoCapture(vidfile)
     vidlength = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
     count = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    while cap.grab():
         count += 1
+    cap.release()
+
+    return count, vidlength
+
 
-    print("video had", vidlength-count, "non-existing frames.. ", end = "")
+def safe_framecount(vidfile, diff = False, verbose = False):
 
-    return count
+    """
+    Saves video frame counter that counts frame-by-frame, by grabbing the
+    frames without decoding them
+
+    diff : bool, default = False
+        If the difference between the reported and counted number of frames
+        should also be returned
+    verbose : bool, default = False
+        If the difference should be printed
+    """
+
+    count, vidlength = _countframes(vidfile)
+
+    if verbose:
+        print("video had", vidlength-count, "non-existing frames.. ", end = "")
+
+    return (count, vidlength-count) if diff else count
+
+
+def framecounts(vidfiles, workers = None, cachefile = ".framecounts.json"):
+
+    """
+    Counts the frames of many video files in parallel using a process pool,
+    grabbing all frames without decoding them as safe_framecount does.
+    Results are cached in a sidecar file in the directory of each video,
+    keyed on file size and mtime, such that unchanged videos are not counted
+    again. If a sidecar file cannot be written, e.g. on a read-only drive,
+    the counts are still returned.
+
+    Parameters
+    ----------
+    vidfiles : list of video files
+    workers : int, default = None
+        Number of processes, default is the number of cpus
+    cachefile : str, default = ".framecounts.json"
+        Name of the sidecar cache file, or None to not use a cache
+
+    Returns
+    -------
+    counts : dict with for each video the counted number of frames and the
+        difference with the reported number of frames
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    caches, counts, todo = {}, {}, []
+    for vidfile in vidfiles:
+        dirname, filename = os.path.split(os.path.abspath(vidfile))
+        stat = os.stat(vidfile)
+        key = [stat.st_size, stat.st_mtime_ns]
+        if cachefile is not None and dirname not in caches:
+            try:
+                with open(os.path.join(dirname, cachefile)) as f:
+                    caches[dirname] = json.load(f)
+            except (OSError, ValueError):
+                caches[dirname] = {}
+        cached = caches.get(dirname, {}).get(filename)
+        if cached is not None and cached["key"] == key:
+            counts[vidfile] = tuple(cached["counts"])
+        else:
+            todo.append((vidfile, dirname, filename, key))
+
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = pool.map(_countframes, [t[0] for t in todo])
+            for (vidfile, dirname, filename, key), (count, vidlength) in \
+                zip(todo, results):
+                counts[vidfile] = (count, vidlength-count)
+                if cachefile is not None:
+                    caches[dirname][filename] = {"key": key,
+                                                 "counts": counts[vidfile]}
+
+    if cachefile is not None:
+        for dirname in set(t[1] for t in todo):
+            tmpfile = os.path.join(dirname, cachefile + ".tmp")
+            try:
+                with open(tmpfile, "w") as f:
+                    json.dump(caches[dirname], f)
+                os.replace(tmpfile, os.path.join(dirname, cachefile))
+            except OSError:
+                try:
+                    os.remove(tmpfile)
+                except OSError:
+                    pass
+
+    return counts
 
 
 def crop(image, pt1, pt2=None):
@@ -133,32 +342,63 @@ def crop(image, pt1, pt2=None):
     return cropped
 
 
-def fourpt_transform(image, pts):
+def fourpt_matrices(pts):
 
     """
-    Perspective transform a section of an image based on four coordinates
-    to obtain a top-down view
+    Computes the perspective transform matrices and output dimensions to get a
+    top-down view of one or K quadrilaterals of four coordinates. The results
+    can be reused with fourpt_transforms for every frame of a video.
+
+    Returns
+    -------
+    matrices : (K,3,3) array of perspective transform matrices
+    dims : list of K (width, height) tuples of the warped images
     """
 
-    rect = sort_points(pts)
-    (tl, tr, br, bl) = rect
+    rects = sort_points(pts).reshape(-1, 4, 2)
+    tl, tr, br, bl = rects.transpose(1, 0, 2)
+
+    def _length(pt1, pt2):
+        return np.sqrt(((pt1 - pt2) ** 2).sum(axis = -1)).astype(int)
+
+    maxWidth = np.maximum(_length(br, bl), _length(tr, tl))
+    maxHeight = np.maximum(_length(tr, br), _length(tl, bl))
+
+    dst = np.zeros_like(rects)
+    dst[:, 1:3, 0] = maxWidth[:, None] - 1
+    dst[:, 2:, 1] = maxHeight[:, None] - 1
 
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    maxWidth = max(int(widthA), int(widthB))
+    matrices = np.array([cv2.getPerspectiveTransform(r, d)
+                         for r, d in zip(rects, dst)])
+    dims = [(int(w), int(h)) for w, h in zip(maxWidth, maxHeight)]
 
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    maxHeight = max(int(heightA), int(heightB))
+    return matrices, dims
 
-    dst = np.array([[0, 0], [maxWidth - 1, 0],
-                    [maxWidth - 1, maxHeight - 1],
-                    [0, maxHeight - 1]], dtype = "float32")
 
-    M = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
+def fourpt_transforms(image, pts = None, matrices = None):
+
+    """
+    Perspective transforms multiple sections of an image based on a (K,4,2)
+    array of coordinates, or on precomputed (matrices, dims) from
+    fourpt_matrices, and returns a list of top-down views
+    """
+
+    if matrices is None:
+        if pts is None:
+            raise ValueError("No pts or matrices provided..")
+        matrices = fourpt_matrices(pts)
+
+    return [cv2.warpPerspective(image, M, dims) for M, dims in zip(*matrices)]
+
+
+def fourpt_transform(image, pts):
+
+    """
+    Perspective transform a section of an image based on four coordinates
+    to obtain a top-down view
+    """
 
-    return warped
+    return fourpt_transforms(image, pts)[0]
 
 
 def checkroi(roi, resolution):